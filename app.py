@@ -1,27 +1,21 @@
-from google.oauth2.service_account import Credentials
-import gspread
+import threading
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import streamlit as st
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 
 st.set_page_config(page_title="Ianalumab Revenue Model", layout="centered")
 
 # --- UTM tracking ---
-try:
-    # 新版 Streamlit
-    params = st.query_params
-except Exception:
-    # 舊版相容
-    params = st.experimental_get_query_params()
+# requirements 已鎖 streamlit>=1.52，不再需要 experimental_get_query_params 的相容寫法
+query_params = st.query_params
 
 utm = {
-    "utm_source": params.get("utm_source", [""])[0] if isinstance(params, dict) else params.get("utm_source", ""),
-    "utm_medium": params.get("utm_medium", [""])[0] if isinstance(params, dict) else params.get("utm_medium", ""),
-    "utm_campaign": params.get("utm_campaign", [""])[0] if isinstance(params, dict) else params.get("utm_campaign", ""),
+    "utm_source": query_params.get("utm_source", ""),
+    "utm_medium": query_params.get("utm_medium", ""),
+    "utm_campaign": query_params.get("utm_campaign", ""),
 }
 
 # 存到 session_state
@@ -35,85 +29,120 @@ if any(utm.values()):
 
 st.title("Ianalumab Revenue & Investment Model")
 
-# Sidebar
-st.sidebar.header("Parameters")
-launch_year = st.sidebar.number_input("Launch Year", 2025, 2035, 2027)
-ramp_years  = st.sidebar.slider("Ramp Years to Peak", 3, 8, 5)
-peak_sales_bil = st.sidebar.number_input("Peak Sales (B$)", 0.1, 5.0, 0.638, step=0.01, format="%.3f")
-pos = st.sidebar.slider("Probability of Success (PoS)", 0.3, 1.0, 0.80, step=0.05)
-ramp_shape = st.sidebar.selectbox("Ramp Shape", ["linear", "fast", "slow"])
-
-cogs_pct = st.sidebar.slider("COGS % of Revenue", 0.05, 0.40, 0.15, step=0.01)
-sga_pct  = st.sidebar.slider("SG&A % of Gross Profit", 0.10, 0.50, 0.25, step=0.01)
-
-prelaunch_years = st.sidebar.slider("Pre-launch Investment Years", 0, 3, 2)
-postlaunch_years = st.sidebar.slider("Post-launch Investment Years", 0, 3, 1)
-total_invest_m = st.sidebar.number_input("Total Investment (USD $M)", 100, 2000, 670, step=10)
+# Sidebar：參數包在 form 裡，按下 Update 才重算
+with st.sidebar.form("params"):
+    st.header("Parameters")
+    launch_year = st.number_input("Launch Year", 2025, 2035, 2027)
+    ramp_years  = st.slider("Ramp Years to Peak", 3, 8, 5)
+    peak_sales_bil = st.number_input("Peak Sales (B$)", 0.1, 5.0, 0.638, step=0.01, format="%.3f")
+    pos = st.slider("Probability of Success (PoS)", 0.3, 1.0, 0.80, step=0.05)
+    ramp_shape = st.selectbox("Ramp Shape", ["linear", "fast", "slow"])
+
+    cogs_pct = st.slider("COGS % of Revenue", 0.05, 0.40, 0.15, step=0.01)
+    sga_pct  = st.slider("SG&A % of Gross Profit", 0.10, 0.50, 0.25, step=0.01)
+
+    prelaunch_years = st.slider("Pre-launch Investment Years", 0, 3, 2)
+    postlaunch_years = st.slider("Post-launch Investment Years", 0, 3, 1)
+    total_invest_m = st.number_input("Total Investment (USD $M)", 100, 2000, 670, step=10)
+
+    st.form_submit_button("Update")
+
+model_params = {
+    "launch_year": launch_year, "ramp_years": ramp_years, "ramp_shape": ramp_shape,
+    "peak_sales_bil": peak_sales_bil, "pos": pos, "cogs_pct": cogs_pct, "sga_pct": sga_pct,
+    "prelaunch_years": prelaunch_years, "postlaunch_years": postlaunch_years,
+    "total_invest_m": total_invest_m,
+}
 
 # Ramp function
+_X5 = np.arange(1, 6, dtype=float)
+_BASE = {
+    "fast": np.array([0.2, 0.5, 0.8, 0.95, 1.0]),
+    "slow": np.array([0.05, 0.2, 0.4, 0.7, 1.0]),
+    "linear": np.linspace(0.1, 1.0, 5),
+}
+
+@st.cache_data(show_spinner=False)
 def ramp_factors(n, kind="linear"):
-    if kind == "fast":
-        base = [0.2, 0.5, 0.8, 0.95, 1.0]
-    elif kind == "slow":
-        base = [0.05, 0.2, 0.4, 0.7, 1.0]
-    else:  # linear
-        base = np.linspace(0.1, 1.0, 5).tolist()
+    base = _BASE.get(kind, _BASE["linear"])
     if n == 5:
         return base
-    x = np.linspace(1, 5, num=5)
-    xi = np.linspace(1, 5, num=n)
-    return np.interp(xi, x, base).tolist()
-
-factors = ramp_factors(ramp_years, ramp_shape)
-years = list(range(launch_year, launch_year + ramp_years))
-
-# Investment allocation
-invest_years = list(range(launch_year - prelaunch_years, launch_year + postlaunch_years))
-invest_per_year_bil = (total_invest_m / 1000.0) / max(1, len(invest_years))
-
-rows = []
-cum_profit = 0.0
-break_even_year = None
-
-for y in years:
-    revenue_b = peak_sales_bil * factors[y - launch_year] * pos
-    gross_profit_b = revenue_b * (1 - cogs_pct)
-    op_profit_b = gross_profit_b * (1 - sga_pct)
-    invest_b = invest_per_year_bil if y in invest_years else 0.0
-    cum_profit += (op_profit_b - invest_b)
-    if break_even_year is None and cum_profit >= 0:
-        break_even_year = y
-    rows.append({
-        "Year": y,
-        "Revenue (B$)": round(revenue_b, 3),
-        "Gross Profit (B$)": round(gross_profit_b, 3),
-        "Operating Profit (B$)": round(op_profit_b, 3),
-        "Investment (B$)": round(invest_b, 3),
-        "Cumulative Profit (B$)": round(cum_profit, 3)
-    })
-
-df = pd.DataFrame(rows)
+    return np.interp(np.linspace(1, 5, num=n), _X5, base)
+
+# 參數沒變就沿用上次的結果
+key = tuple(model_params.values())
+if st.session_state.get("key") != key:
+    factors = ramp_factors(ramp_years, ramp_shape)
+    years_arr = np.arange(launch_year, launch_year + ramp_years)
+
+    # Investment allocation
+    invest_start, invest_end = launch_year - prelaunch_years, launch_year + postlaunch_years
+    invest_per_year_bil = (total_invest_m / 1000.0) / max(1, invest_end - invest_start)
+    invest_mask = (years_arr >= invest_start) & (years_arr < invest_end)
+
+    revenue = peak_sales_bil * factors * pos
+    gross = revenue * (1 - cogs_pct)
+    op = gross * (1 - sga_pct)
+    invest = np.where(invest_mask, invest_per_year_bil, 0.0)
+    cum = np.cumsum(op - invest)
+
+    idx = np.argmax(cum >= 0)
+    break_even_year = int(years_arr[idx]) if cum[idx] >= 0 else None
+
+    df = pd.DataFrame({
+        "Year": years_arr,
+        "Revenue (B$)": revenue,
+        "Gross Profit (B$)": gross,
+        "Operating Profit (B$)": op,
+        "Investment (B$)": invest,
+        "Cumulative Profit (B$)": cum,
+    }).round(3)
+
+    st.session_state["df"] = df
+    st.session_state["break_even_year"] = break_even_year
+    st.session_state["key"] = key
+
+df = st.session_state["df"].copy()
+break_even_year = st.session_state["break_even_year"]
+
 st.subheader("Forecast Table")
-st.dataframe(df, use_container_width=True)
+st.dataframe(df, width="stretch")
 
 # Chart
 st.subheader("Revenue & Cumulative Profit")
-fig, ax = plt.subplots(figsize=(8, 4.5))
-ax.plot(df["Year"], df["Revenue (B$)"], marker="o", label="Revenue (B$)")
-ax.plot(df["Year"], df["Cumulative Profit (B$)"], marker="o", label="Cumulative Profit (B$)")
-ax.set_xlabel("Year"); ax.set_ylabel("Billion USD"); ax.grid(True); ax.legend()
-st.pyplot(fig)
+# Year 轉成字串，讓 x 軸當類別顯示（避免出現 2,027 這種刻度）
+chart_df = df.set_index(df["Year"].astype(str))[["Revenue (B$)", "Cumulative Profit (B$)"]]
+st.line_chart(chart_df, x_label="Year", y_label="Billion USD")
 
 st.markdown("---")
 st.write(f"**Approx. Break-even Year:** {break_even_year if break_even_year else 'Not reached'}")
-st.caption("Change PoS, Ramp Shape, or Investment to see how break-even shifts.")
+st.caption("Change PoS, Ramp Shape, or Investment and click Update to see how break-even shifts.")
 
 # 把 UTM 寫到每列
 for k, v in st.session_state["utm"].items():
     df[k] = v
 # --- Google Sheets logger ---
+SHEET_HEADER = [
+    "timestamp_taipei","name","linkedin_url",
+    "utm_source","utm_medium","utm_campaign",
+    "launch_year","ramp_years","ramp_shape",
+    "peak_sales_bil","pos","cogs_pct","sga_pct",
+    "prelaunch_years","postlaunch_years","total_invest_m",
+    "break_even_year"
+]
+
+# gspread / google-auth 只在真的要寫入時才 import
+def sheets_enabled():
+    try:
+        return "gcp_service_account" in st.secrets and "sheets" in st.secrets
+    except Exception:  # 沒有 secrets.toml
+        return False
+
 @st.cache_resource(show_spinner=False)
-def _open_worksheet():
+def _gspread_client():
+    from google.oauth2.service_account import Credentials
+    import gspread
+
     creds = Credentials.from_service_account_info(
         st.secrets["gcp_service_account"],
         scopes=[
@@ -121,41 +150,96 @@ def _open_worksheet():
             "https://www.googleapis.com/auth/drive",
         ],
     )
-    gc = gspread.authorize(creds)
+    return gspread.authorize(creds)
+
+@st.cache_resource(show_spinner=False)
+def _open_worksheet():
+    import gspread
+
+    gc = _gspread_client()
     sh = gc.open_by_key(st.secrets["sheets"]["sheet_key"])
     ws_name = st.secrets["sheets"].get("worksheet", "runs")
     try:
         ws = sh.worksheet(ws_name)
+        header_written = True
     except gspread.WorksheetNotFound:
         ws = sh.add_worksheet(title=ws_name, rows=1000, cols=30)
-        # 可選：先寫表頭
-        ws.append_row([
-            "timestamp_taipei","name","linkedin_url",
-            "utm_source","utm_medium","utm_campaign",
-            "launch_year","ramp_years","ramp_shape",
-            "peak_sales_bil","pos","cogs_pct","sga_pct",
-            "prelaunch_years","postlaunch_years","total_invest_m",
-            "break_even_year"
-        ])
-    return ws
-
-def log_run():
-    ws = _open_worksheet()
+        # 新表的表頭跟第一批資料一起上傳，省一次 API 呼叫
+        header_written = False
+    # cache_resource 由所有 session 共用，header_written 要靠 lock 保護
+    return {"ws": ws, "header_written": header_written, "lock": threading.Lock()}
+
+# 先排進 pending_rows，之後一次 append_rows 上傳
+def log_run(name, linkedin_url, model_params, break_even_year):
     tz = ZoneInfo("Asia/Taipei")
     ts = datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
     utm = st.session_state.get("utm", {"utm_source":"", "utm_medium":"", "utm_campaign":""})
-    ws.append_row([
+    st.session_state.setdefault("pending_rows", []).append([
         ts,
         name, linkedin_url,
         utm.get("utm_source",""), utm.get("utm_medium",""), utm.get("utm_campaign",""),
-        launch_year, ramp_years, ramp_shape,
-        float(peak_sales_bil), float(pos), float(cogs_pct), float(sga_pct),
-        prelaunch_years, postlaunch_years, total_invest_m,
+        model_params["launch_year"], model_params["ramp_years"], model_params["ramp_shape"],
+        float(model_params["peak_sales_bil"]), float(model_params["pos"]),
+        float(model_params["cogs_pct"]), float(model_params["sga_pct"]),
+        model_params["prelaunch_years"], model_params["postlaunch_years"], model_params["total_invest_m"],
         break_even_year or ""
-    ], value_input_option="USER_ENTERED")
-
-# Download
-csv = df.to_csv(index=False).encode("utf-8")
-st.download_button("Download CSV", csv, "ianalumab_model.csv", "text/csv")
+    ])
+
+def flush_runs():
+    rows = st.session_state.get("pending_rows", [])
+    if not rows:
+        return 0
+    sheet = _open_worksheet()
+    if sheet["header_written"]:
+        sheet["ws"].append_rows(rows, value_input_option="USER_ENTERED")
+    else:
+        with sheet["lock"]:
+            batch = rows if sheet["header_written"] else [SHEET_HEADER, *rows]
+            sheet["ws"].append_rows(batch, value_input_option="USER_ENTERED")
+            sheet["header_written"] = True
+    st.session_state["pending_rows"] = []
+    return len(rows)
+
+# 只重跑這個 fragment，不會重算表格和圖
+@st.fragment
+def save_fragment(model_params, break_even_year):
+    st.subheader("Save this run to Google Sheet")
+    name = st.text_input("Name")
+    linkedin_url = st.text_input("LinkedIn URL")
+    consent = st.checkbox("I agree to have this run and my details saved.")
+    if st.button("Save this run", disabled=not consent):
+        log_run(name, linkedin_url, model_params, break_even_year)
+        st.info("Run queued. Click Upload to send it — queued runs are lost if you close this tab.")
+
+    # 沒勾同意就不能上傳，已排隊的資料也一樣
+    pending = len(st.session_state.get("pending_rows", []))
+    if st.button(f"Upload saved runs ({pending})", disabled=not (consent and pending)):
+        try:
+            n = flush_runs()
+        except Exception as e:
+            st.error(f"Could not save to Google Sheet: {e}")
+        else:
+            # 整頁重跑讓按鈕上的筆數歸零（預測結果沿用，不會重算），訊息留到下一輪顯示
+            # 不用 scope="fragment"：點擊若併入整頁重跑會丟 StreamlitInvalidLayoutContextError
+            st.session_state["upload_msg"] = f"Uploaded {n} run(s)."
+            st.rerun()
+    if "upload_msg" in st.session_state:
+        st.success(st.session_state.pop("upload_msg"))
+
+if sheets_enabled():
+    save_fragment(model_params, break_even_year)
+
+# Download：CSV 等按下去才產生，同樣的表格不重複編碼
+# UTM 欄位來自網址，鍵值不受控，所以限制快取筆數與存活時間
+@st.cache_data(show_spinner=False, max_entries=64, ttl=3600)
+def to_csv_bytes(df: pd.DataFrame) -> bytes:
+    return df.to_csv(index=False).encode("utf-8")
+
+st.download_button(
+    "Download CSV",
+    lambda: to_csv_bytes(df),
+    "ianalumab_model.csv",
+    "text/csv",
+)
 
 